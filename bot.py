@@ -7,15 +7,15 @@ Sends a file every Sunday using the huami-token project
 import asyncio
 import logging
 import os
-import subprocess
-from datetime import datetime, timedelta
+import re
+from datetime import datetime, time, timedelta
+from functools import wraps
 from pathlib import Path
 from typing import Optional
 
-import aiohttp
-from telegram import Bot, Update
+from telegram import Bot, InputMediaDocument, Update
 from telegram.ext import Application, CommandHandler, ContextTypes, JobQueue
-from telegram.error import TelegramError
+from telegram.error import RetryAfter, TelegramError, TimedOut
 
 # Configure logging
 logging.basicConfig(
@@ -24,34 +24,66 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Configuration from environment variables, read once at import
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
+HUAMI_EMAIL = os.getenv('HUAMI_EMAIL')
+HUAMI_PASSWORD = os.getenv('HUAMI_PASSWORD')
+AUTHORIZED_USERS = os.getenv('AUTHORIZED_USERS', '')
+
+# Device line printed by huami-token, e.g. "MAC: xx:xx, Active: Yes, Key: 0x..."
+DEVICE_LINE_RE = re.compile(r'MAC:\s*([^,]+),\s*Active:\s*([^,]+),.*Key:\s*(\S+)')
+
+# Extensions of the GPS files produced by huami-token
+OUTPUT_SUFFIXES = ('.zip', '.bin')
+
+# Maximum number of documents Telegram accepts in a single media group
+MEDIA_GROUP_SIZE = 10
+
+# Attempts per upload before giving up on rate limits or timeouts
+SEND_ATTEMPTS = 3
+
+def require_auth(handler):
+    """Reject commands from users who are not authorized to use the bot"""
+    @wraps(handler)
+    async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if not self.is_authorized(update.effective_user.id):
+            await update.message.reply_text("❌ You are not authorized to use this bot.")
+            return
+        await handler(self, update, context)
+    return wrapper
+
 class WeeklyFileBot:
     def __init__(self):
-        self.token = os.getenv('TELEGRAM_BOT_TOKEN')
-        self.chat_id = os.getenv('TELEGRAM_CHAT_ID')
-        self.huami_email = os.getenv('HUAMI_EMAIL')
-        self.huami_password = os.getenv('HUAMI_PASSWORD')
-        self.authorized_users = set()
+        self.token = TELEGRAM_BOT_TOKEN
+        # Parsed from TELEGRAM_CHAT_ID in run() so a malformed value is reported cleanly
+        self.chat_id_int: Optional[int] = None
+        self.huami_email = HUAMI_EMAIL
+        self.huami_password = HUAMI_PASSWORD
         
-        # Parse authorized users from environment variable
-        authorized_users_str = os.getenv('AUTHORIZED_USERS', '')
-        if authorized_users_str:
-            self.authorized_users = set(int(user_id.strip()) for user_id in authorized_users_str.split(','))
+        # Parsed from AUTHORIZED_USERS in run(); nobody is let in until then
+        self.authorized_users: frozenset = frozenset()
+        self._auth_open = False
         
         self.huami_token_dir = Path('/app/huami-token')
         
+        # Shared bot instance, set in run() from the Application so every send
+        # reuses the same HTTP connection pool
+        self.bot: Optional[Bot] = None
+        
+        # Next scheduled send, reused until that moment has passed
+        self._cached_next_friday: Optional[datetime] = None
+        
+        # Serialize generate-and-send runs so concurrent sends don't share output files
+        self._generate_lock = asyncio.Lock()
+        
     def is_authorized(self, user_id: int) -> bool:
         """Check if user is authorized to use the bot"""
-        # If no authorized users are configured, allow everyone (backward compatibility)
-        if not self.authorized_users:
-            return True
-        return user_id in self.authorized_users
+        return self._auth_open or user_id in self.authorized_users
         
+    @require_auth
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /start command"""
-        if not self.is_authorized(update.effective_user.id):
-            await update.message.reply_text("❌ You are not authorized to use this bot.")
-            return
-            
         await update.message.reply_text(
             "🤖 GPS Data Bot is active!\n\n"
             "I send GPS data files every Friday automatically.\n"
@@ -61,68 +93,66 @@ class WeeklyFileBot:
             "/next_send - Show next scheduled send time"
         )
     
+    @require_auth
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /status command"""
-        if not self.is_authorized(update.effective_user.id):
-            await update.message.reply_text("❌ You are not authorized to use this bot.")
-            return
-            
         next_send = self.get_next_friday()
         await update.message.reply_text(
             f"✅ Bot is running\n"
             f"📅 Next scheduled send: {next_send.strftime('%Y-%m-%d %H:%M')}\n"
         )
     
+    @require_auth
     async def send_now_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /send_now command"""
-        if not self.is_authorized(update.effective_user.id):
-            await update.message.reply_text("❌ You are not authorized to use this bot.")
-            return
-            
         await update.message.reply_text("🔄 Generating GPS files now...")
         
         try:
-            file_paths = await self.generate_file()
-            if file_paths:
-                await self.send_file(update.effective_chat.id, file_paths)
+            file_paths, success = await self.generate_and_send(update.effective_chat.id)
+            if not file_paths:
+                await update.message.reply_text("❌ Failed to generate GPS files")
+            elif success:
                 await update.message.reply_text(f"✅ {len(file_paths)} GPS files sent successfully!")
             else:
-                await update.message.reply_text("❌ Failed to generate GPS files")
+                await update.message.reply_text("❌ Failed to send GPS files")
         except Exception as e:
             logger.error(f"Error in send_now: {e}")
             await update.message.reply_text(f"❌ Error: {str(e)}")
     
+    @require_auth
     async def next_send_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /next_send command"""
-        if not self.is_authorized(update.effective_user.id):
-            await update.message.reply_text("❌ You are not authorized to use this bot.")
-            return
-            
-        next_send = self.get_next_friday()
+        now = datetime.now()
+        next_send = self.get_next_friday(now)
         await update.message.reply_text(
             f"📅 Next automatic send: {next_send.strftime('%Y-%m-%d %H:%M')}\n"
-            f"⏰ Time remaining: {self.get_time_until_next_friday()}"
+            f"⏰ Time remaining: {self.get_time_until_next_friday(now, next_send)}"
         )
     
-    def get_next_friday(self) -> datetime:
+    def get_next_friday(self, now: Optional[datetime] = None) -> datetime:
         """Calculate next Friday at 10:00 AM"""
-        now = datetime.now()
+        now = now or datetime.now()
+        if self._cached_next_friday is not None and now < self._cached_next_friday:
+            return self._cached_next_friday
+        
         days_until_friday = (4 - now.weekday()) % 7
         if days_until_friday == 0 and now.hour >= 10:
             days_until_friday = 7
         
         next_friday = now + timedelta(days=days_until_friday)
-        return next_friday.replace(hour=10, minute=0, second=0, microsecond=0)
+        self._cached_next_friday = next_friday.replace(hour=10, minute=0, second=0, microsecond=0)
+        return self._cached_next_friday
     
-    def get_time_until_next_friday(self) -> str:
+    def get_time_until_next_friday(self, now: Optional[datetime] = None,
+                                   next_friday: Optional[datetime] = None) -> str:
         """Get human readable time until next Friday"""
-        next_friday = self.get_next_friday()
-        now = datetime.now()
-        delta = next_friday - now
+        now = now or datetime.now()
+        next_friday = next_friday or self.get_next_friday(now)
+        total_seconds = int((next_friday - now).total_seconds())
         
-        days = delta.days
-        hours = delta.seconds // 3600
-        minutes = (delta.seconds % 3600) // 60
+        days, remainder = divmod(total_seconds, 86400)
+        hours, remainder = divmod(remainder, 3600)
+        minutes = remainder // 60
         
         if days > 0:
             return f"{days}d {hours}h {minutes}m"
@@ -131,14 +161,23 @@ class WeeklyFileBot:
         else:
             return f"{minutes}m"
     
+    async def generate_and_send(self, chat_id: int) -> tuple:
+        """Generate GPS files and send them, returning (file_paths, success)"""
+        # huami-token writes fixed file names, so hold the lock until this
+        # run's files are sent and deleted before another run can start
+        async with self._generate_lock:
+            file_paths = await self.generate_file()
+            if not file_paths:
+                return None, False
+            return file_paths, await self.send_file(chat_id, file_paths)
+    
     async def generate_file(self) -> Optional[list]:
         """Generate GPS files using huami-token script"""
+        huami_dir = self.huami_token_dir
+        
         try:
             logger.info("Running huami-token script...")
             
-            # Change to huami-token directory
-            os.chdir(self.huami_token_dir)
-            
             # Run huami-token command with correct syntax
             cmd = [
                 'huami-token',
@@ -148,34 +187,54 @@ class WeeklyFileBot:
                 '--gps'
             ]
             
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=120
+            # huami-token reuses fixed file names, so new output is told apart
+            # from leftovers of earlier runs by modification time
+            started_at = datetime.now().timestamp()
+            
+            # Run in the huami-token directory without blocking the event loop
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                cwd=str(huami_dir),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
             )
             
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=120)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                logger.error("huami-token script timed out")
+                return None
+            
+            stdout = stdout.decode(errors='replace')
+            stderr = stderr.decode(errors='replace')
+            
             # Log command output
-            if result.stdout:
-                logger.info(f"huami-token stdout: {result.stdout}")
-            if result.stderr:
-                logger.warning(f"huami-token stderr: {result.stderr}")
+            if stdout:
+                logger.info(f"huami-token stdout: {stdout}")
+            if stderr:
+                logger.warning(f"huami-token stderr: {stderr}")
             
-            if result.returncode != 0:
-                logger.error(f"huami-token failed with return code {result.returncode}")
+            if proc.returncode != 0:
+                logger.error(f"huami-token failed with return code {proc.returncode}")
                 return None
             
             logger.info("GPS data download completed")
             
-            # Find all .zip and .bin files in huami-token directory
+            # Find all new .zip and .bin files in huami-token directory
             generated_files = []
-            huami_dir = Path('/app/huami-token')
             
-            # Look for all .zip and .bin files
-            for file_path in huami_dir.iterdir():
-                if file_path.is_file() and file_path.suffix.lower() in ['.zip', '.bin']:
-                    generated_files.append(file_path)
-                    logger.info(f"Found generated file: {file_path}")
+            # Look for all .zip and .bin files written by this run; the name
+            # check comes first so non-matching entries never need a stat()
+            with os.scandir(huami_dir) as entries:
+                for entry in entries:
+                    if not entry.name.lower().endswith(OUTPUT_SUFFIXES):
+                        continue
+                    if entry.is_file() and entry.stat().st_mtime >= started_at:
+                        file_path = Path(entry.path)
+                        generated_files.append(file_path)
+                        logger.info(f"Found generated file: {file_path}")
             
             if generated_files:
                 return generated_files
@@ -183,9 +242,6 @@ class WeeklyFileBot:
                 logger.error("No .zip or .bin files found")
                 return None
                 
-        except subprocess.TimeoutExpired:
-            logger.error("huami-token script timed out")
-            return None
         except Exception as e:
             logger.error(f"Error running huami-token: {e}")
             return None
@@ -195,20 +251,13 @@ class WeeklyFileBot:
         key_info = None
         
         for line in output_lines:
-            if 'Device' in line and 'MAC:' in line and 'Key:' in line:
-                # Extract MAC address
-                mac_start = line.find('MAC:') + 4
-                mac_end = line.find(',', mac_start)
-                mac = line[mac_start:mac_end].strip()
-                
-                # Extract key
-                key_start = line.find('Key:') + 4
-                key = line[key_start:].strip()
-                
-                # Extract active status
-                active_start = line.find('Active:') + 7
-                active_end = line.find(',', active_start)
-                active = line[active_start:active_end].strip()
+            # Cheap substring check skips non-device lines before the regex runs
+            if 'Device' not in line:
+                continue
+            
+            match = DEVICE_LINE_RE.search(line)
+            if match:
+                mac, active, key = (group.strip() for group in match.groups())
                 
                 key_info = {
                     'mac': mac,
@@ -235,87 +284,113 @@ Bluetooth Key: {key_info['key']}
 This file was automatically generated by the Weekly File Bot.
 """
         
-        with open(file_path, 'w') as f:
-            f.write(content)
+        file_path.write_text(content, encoding='utf-8')
         
         logger.info(f"Created output file: {file_path}")
         return file_path
     
     async def send_file(self, chat_id: int, file_paths: list) -> bool:
         """Send multiple GPS files to Telegram chat and delete them"""
-        try:
-            bot = Bot(token=self.token)
+        bot = self.bot
+        
+        async def _send_group(group: list) -> None:
+            caption = (
+                f"📄 GPS Data Files\n"
+                f"Files: {', '.join(file_path.name for file_path in group)}\n"
+                f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            )
+            
+            # Read files in a worker thread so slow disks don't stall the event loop
+            contents = await asyncio.gather(
+                *(asyncio.to_thread(file_path.read_bytes) for file_path in group)
+            )
             
-            for file_path in file_paths:
-                with open(file_path, 'rb') as file:
-                    await bot.send_document(
-                        chat_id=chat_id,
-                        document=file,
-                        caption=f"📄 GPS Data File\nFile: {file_path.name}\nGenerated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-                    )
+            # Retry transient failures here instead of regenerating everything later
+            for attempt in range(SEND_ATTEMPTS):
+                try:
+                    if len(group) == 1:
+                        # sendMediaGroup needs at least two items
+                        await bot.send_document(
+                            chat_id=chat_id,
+                            document=contents[0],
+                            filename=group[0].name,
+                            caption=caption
+                        )
+                    else:
+                        # Only the first document carries the caption
+                        media = [
+                            InputMediaDocument(
+                                media=data,
+                                filename=file_path.name,
+                                caption=caption if index == 0 else None
+                            )
+                            for index, (file_path, data) in enumerate(zip(group, contents))
+                        ]
+                        await bot.send_media_group(chat_id=chat_id, media=media)
+                    break
+                except RetryAfter as e:
+                    if attempt == SEND_ATTEMPTS - 1:
+                        raise
+                    logger.warning(f"Rate limited by Telegram, retrying in {e.retry_after}s")
+                    await asyncio.sleep(e.retry_after)
+                except TimedOut:
+                    if attempt == SEND_ATTEMPTS - 1:
+                        raise
+                    logger.warning(f"Telegram request timed out, retrying in {2 ** attempt}s")
+                    await asyncio.sleep(2 ** attempt)
+            
+            for file_path in group:
                 logger.info(f"Sent file: {file_path}")
                 
                 # Delete file after successful send
                 try:
-                    file_path.unlink()
+                    await asyncio.to_thread(file_path.unlink)
                     logger.info(f"Deleted file: {file_path}")
                 except Exception as e:
                     logger.warning(f"Failed to delete file {file_path}: {e}")
-            
-            logger.info(f"All {len(file_paths)} files sent and deleted successfully")
-            return True
-            
-        except TelegramError as e:
-            logger.error(f"Telegram error: {e}")
-            return False
-        except Exception as e:
-            logger.error(f"Error sending files: {e}")
+        
+        groups = [
+            file_paths[start:start + MEDIA_GROUP_SIZE]
+            for start in range(0, len(file_paths), MEDIA_GROUP_SIZE)
+        ]
+        results = await asyncio.gather(
+            *(_send_group(group) for group in groups),
+            return_exceptions=True
+        )
+        
+        failed = 0
+        for group, result in zip(groups, results):
+            if isinstance(result, TelegramError):
+                logger.error(f"Telegram error sending {len(group)} files: {result}")
+                failed += len(group)
+            elif isinstance(result, Exception):
+                logger.error(f"Error sending {len(group)} files: {result}")
+                failed += len(group)
+        
+        if failed:
+            logger.error(f"{failed} of {len(file_paths)} files failed to send")
             return False
-    
-    async def weekly_scheduler(self) -> None:
-        """Background task for weekly file sending"""
-        while True:
-            try:
-                now = datetime.now()
-                next_friday = self.get_next_friday()
-                
-                # Sleep until next Friday
-                sleep_seconds = (next_friday - now).total_seconds()
-                logger.info(f"Sleeping {sleep_seconds/3600:.1f} hours until next Friday")
-                
-                await asyncio.sleep(sleep_seconds)
-                
-                # Generate and send file
-                logger.info("Starting weekly file generation...")
-                file_path = await self.generate_file()
-                
-                if file_path and self.chat_id:
-                    success = await self.send_file(int(self.chat_id), file_path)
-                    if success:
-                        logger.info("Weekly file sent successfully")
-                    else:
-                        logger.error("Failed to send weekly file")
-                else:
-                    logger.error("Failed to generate file or no chat_id configured")
-                    
-            except Exception as e:
-                logger.error(f"Error in weekly scheduler: {e}")
-                # Wait 1 hour before retrying
-                await asyncio.sleep(3600)
+        
+        logger.info(f"All {len(file_paths)} files sent and deleted successfully")
+        return True
     
     async def weekly_job_callback(self, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Callback for weekly scheduled job"""
         logger.info("Starting weekly GPS data generation...")
-        file_paths = await self.generate_file()
+        # This week's send is due now; recompute the next one on demand
+        self._cached_next_friday = None
         
-        if file_paths and self.chat_id:
-            success = await self.send_file(int(self.chat_id), file_paths)
-            if success:
-                logger.info(f"Weekly GPS files ({len(file_paths)}) sent successfully")
-            else:
-                logger.error("Failed to send weekly GPS files")
+        if self.chat_id_int is None:
+            logger.error("No chat_id configured")
+            return
+        
+        file_paths, success = await self.generate_and_send(self.chat_id_int)
+        if not file_paths:
+            logger.error("Failed to generate GPS files")
+        elif success:
+            logger.info(f"Weekly GPS files ({len(file_paths)}) sent successfully")
         else:
-            logger.error("Failed to generate GPS files or no chat_id configured")
+            logger.error("Failed to send weekly GPS files")
     
     def run(self) -> None:
         """Start the bot"""
@@ -323,7 +398,14 @@ This file was automatically generated by the Weekly File Bot.
             logger.error("TELEGRAM_BOT_TOKEN not set")
             return
         
-        if not self.chat_id:
+        if TELEGRAM_CHAT_ID:
+            try:
+                self.chat_id_int = int(TELEGRAM_CHAT_ID)
+            except ValueError:
+                logger.error("TELEGRAM_CHAT_ID must be an integer")
+                return
+        
+        if self.chat_id_int is None:
             logger.error("TELEGRAM_CHAT_ID not set")
             return
         
@@ -331,9 +413,32 @@ This file was automatically generated by the Weekly File Bot.
             logger.error("HUAMI_EMAIL or HUAMI_PASSWORD not set")
             return
         
+        try:
+            self.authorized_users = frozenset(
+                int(user_id) for user_id in AUTHORIZED_USERS.split(',') if user_id.strip()
+            )
+        except ValueError:
+            logger.error("AUTHORIZED_USERS must be a comma-separated list of integer user IDs")
+            return
+        
+        # If no authorized users are configured, allow everyone (backward compatibility)
+        self._auth_open = not self.authorized_users
+        
         # Create application with job queue
         job_queue = JobQueue()
-        application = Application.builder().token(self.token).job_queue(job_queue).build()
+        application = (
+            Application.builder()
+            .token(self.token)
+            .job_queue(job_queue)
+            # Keep connections to the Bot API alive and multiplex uploads over HTTP/2
+            .connection_pool_size(32)
+            .pool_timeout(10)
+            .http_version('2')
+            .build()
+        )
+        
+        # Reuse the application's bot; its session is closed when polling stops
+        self.bot = application.bot
         
         # Add command handlers
         application.add_handler(CommandHandler("start", self.start_command))
@@ -344,8 +449,8 @@ This file was automatically generated by the Weekly File Bot.
         # Schedule weekly job - every Friday at 10:00 AM
         job_queue.run_daily(
             callback=self.weekly_job_callback,
-            time=datetime.now().replace(hour=10, minute=0, second=0, microsecond=0),
-            days=(4,),  # Friday is day 4 (0=Monday)
+            time=time(hour=10),
+            days=(5,),  # Friday is day 5 (0=Sunday in python-telegram-bot 20)
             name="weekly_file_send"
         )
         